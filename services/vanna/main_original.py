@@ -1,13 +1,21 @@
 import os
 import re
 import asyncio
+import math
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import partial
 from typing import Optional, List, Dict, Any
-from fastapi import FastAPI, HTTPException, Header, Depends
+from urllib.parse import urlsplit
+from fastapi import FastAPI, HTTPException, Header, Depends, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
 from pydantic import BaseModel
 import asyncpg
-from groq import Groq
+from groq import Groq, RateLimitError, APITimeoutError
 from dotenv import load_dotenv
 import sqlparse
 
@@ -26,6 +34,36 @@ app.add_middleware(
 
 # Configuration
 DATABASE_URL = os.getenv("DATABASE_URL")
+def parse_dsn_list(value: str) -> List[str]:
+    """
+    Split a comma-separated list of DSNs. Only commas followed by a URL scheme
+    separate entries, so multi-host DSNs (postgresql://h1:5432,h2:5433/db) stay intact.
+    """
+    value = value.strip().rstrip(",")
+    return [u.strip() for u in re.split(r",\s*(?=[a-z][a-z0-9+.-]*://)", value) if u.strip()]
+
+# Comma-separated list of read-only DSNs; generated SELECTs are routed here
+DATABASE_READ_URLS = parse_dsn_list(os.getenv("DATABASE_READ_URLS", ""))
+# Replicas are probed through pg_stat_wal_receiver. Any role can see whether the
+# receiver is running; granting pg_monitor (or pg_read_all_stats) to the read role
+# also lets the probe see a receiver that is running but not streaming.
+REPLICA_MAX_LAG_SECONDS = float(os.getenv("REPLICA_MAX_LAG_SECONDS", "30"))
+REPLICA_HEALTH_INTERVAL = float(os.getenv("REPLICA_HEALTH_INTERVAL", "5"))
+# Admission control: initial/max concurrency and target latency per pipeline stage
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", "8"))
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "32"))
+LLM_TARGET_LATENCY = float(os.getenv("LLM_TARGET_LATENCY", "5"))
+DB_CONCURRENCY = int(os.getenv("DB_CONCURRENCY", "10"))
+DB_MAX_CONCURRENCY = int(os.getenv("DB_MAX_CONCURRENCY", "40"))
+DB_TARGET_LATENCY = float(os.getenv("DB_TARGET_LATENCY", "2"))
+# How long a query may wait for a pooled connection; timing out is an overload signal
+DB_ACQUIRE_TIMEOUT = float(os.getenv("DB_ACQUIRE_TIMEOUT", str(DB_TARGET_LATENCY)))
+ADMISSION_QUEUE_SIZE = int(os.getenv("ADMISSION_QUEUE_SIZE", "50"))
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "10"))
+# Cap on one key's share of the queue while other keys are also waiting. A lone
+# key can use the whole queue: all authenticated callers share VANNA_API_KEY, so
+# in practice traffic is one key plus per-host keys for unauthenticated callers.
+ADMISSION_QUEUE_PER_KEY = int(os.getenv("ADMISSION_QUEUE_PER_KEY", "10"))
 GROQ_API_KEY = os.getenv("GROQ_API_KEY")
 VANNA_API_KEY = os.getenv("VANNA_API_KEY")
 PORT = int(os.getenv("PORT", "8000"))
@@ -59,6 +97,14 @@ async def verify_api_key(authorization: Optional[str] = Header(None)):
             raise HTTPException(status_code=403, detail="Invalid API key")
     return True
 
+# Key used for fair queueing between callers. Only a validated API key is
+# trusted; otherwise a caller could mint a fresh bucket per request by sending
+# arbitrary tokens, so fall back to the client address.
+async def client_key(request: Request, authorization: Optional[str] = Header(None)) -> str:
+    if VANNA_API_KEY and authorization == f"Bearer {VANNA_API_KEY}":
+        return f"key:{VANNA_API_KEY}"
+    return f"host:{request.client.host}" if request.client else "anonymous"
+
 # SQL sanitization
 def sanitize_sql(sql: str) -> tuple[bool, str]:
     """
@@ -94,16 +140,417 @@ def sanitize_sql(sql: str) -> tuple[bool, str]:
     
     return True, sql
 
-# Database connection pool
-async def get_db_pool():
-    if not DATABASE_URL:
-        raise ValueError("DATABASE_URL not set")
-    
-    # Convert psycopg URL to asyncpg format if needed
-    db_url = DATABASE_URL.replace("postgresql+psycopg://", "postgresql://")
-    
-    pool = await asyncpg.create_pool(db_url, min_size=1, max_size=5)
-    return pool
+# Connection errors that should take a replica out of rotation and fall back to the primary
+CONNECTION_ERRORS = (
+    OSError,
+    asyncpg.PostgresConnectionError,
+    asyncpg.CannotConnectNowError,
+    asyncpg.InterfaceError,
+)
+
+def to_asyncpg_url(url: str) -> str:
+    """Convert psycopg URL to asyncpg format if needed"""
+    return url.replace("postgresql+psycopg://", "postgresql://")
+
+def redact_dsn(url: str) -> str:
+    """Reduce a DSN to host:port/db, dropping user, password and query options"""
+    parsed = urlsplit(to_asyncpg_url(url))
+    try:
+        return f"{parsed.hostname or 'localhost'}:{parsed.port or 5432}{parsed.path}"
+    except ValueError:
+        # Multi-host DSNs have no single port; keep the host list without userinfo
+        return f"{parsed.netloc.rsplit('@', 1)[-1]}{parsed.path}"
+
+class ReadReplica:
+    """
+    A read-only DSN with its own pool and the routing state used to balance across replicas.
+    """
+    def __init__(self, dsn: str):
+        self.dsn = dsn
+        self.pool: Optional[asyncpg.Pool] = None
+        self.healthy = False
+        self.lag_seconds: Optional[float] = None
+        self.outstanding = 0
+        # Exponentially weighted moving average of query latency (seconds)
+        self.latency = 0.05
+        self.last_error: Optional[str] = None
+
+    def score(self) -> float:
+        # Least outstanding requests, weighted by observed latency
+        return (self.outstanding + 1) * self.latency
+
+    def record_latency(self, elapsed: float):
+        self.latency = 0.8 * self.latency + 0.2 * elapsed
+
+    def mark_down(self, error: str):
+        self.healthy = False
+        self.last_error = error
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "healthy": self.healthy,
+            "lag_seconds": self.lag_seconds,
+            "outstanding": self.outstanding,
+            "latency_ms": round(self.latency * 1000, 2),
+            "error": self.last_error,
+        }
+
+class ReplicaRouter:
+    """
+    Owns the primary pool plus one pool per read replica, routes SELECTs to the
+    healthiest replica and falls back to the primary when none is usable.
+    """
+    def __init__(self, primary_url: Optional[str], replica_urls: List[str],
+                 acquire_timeout: float = DB_ACQUIRE_TIMEOUT):
+        self.primary_url = primary_url
+        self.acquire_timeout = acquire_timeout
+        self.primary: Optional[asyncpg.Pool] = None
+        self.replicas = [ReadReplica(url) for url in replica_urls]
+        self._health_task: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+
+    async def get_primary(self) -> asyncpg.Pool:
+        if self.primary is None:
+            if not self.primary_url:
+                raise ValueError("DATABASE_URL not set")
+            async with self._lock:
+                if self.primary is None:
+                    self.primary = await asyncpg.create_pool(
+                        to_asyncpg_url(self.primary_url), min_size=1, max_size=5
+                    )
+        return self.primary
+
+    async def start(self):
+        # Probe in the background so an unreachable replica can't hold up startup;
+        # replicas stay out of rotation until their first successful check
+        if self.replicas:
+            self._health_task = asyncio.create_task(self._health_loop())
+
+    async def close(self):
+        if self._health_task:
+            self._health_task.cancel()
+        pools = [r.pool for r in self.replicas if r.pool] + ([self.primary] if self.primary else [])
+        await asyncio.gather(*(p.close() for p in pools), return_exceptions=True)
+
+    async def _health_loop(self):
+        while True:
+            await self.check_replicas()
+            await asyncio.sleep(REPLICA_HEALTH_INTERVAL)
+
+    async def primary_lsn(self) -> Optional[str]:
+        """Current WAL position on the primary, or None if it can't be reached."""
+        try:
+            pool = await asyncio.wait_for(self.get_primary(), timeout=REPLICA_HEALTH_INTERVAL)
+            async with pool.acquire(timeout=REPLICA_HEALTH_INTERVAL) as conn:
+                return await conn.fetchval("SELECT pg_current_wal_lsn()::text", timeout=REPLICA_HEALTH_INTERVAL)
+        except Exception:
+            return None
+
+    async def check_replicas(self):
+        lsn = await self.primary_lsn()
+        await asyncio.gather(*(self.check_replica(r, lsn) for r in self.replicas))
+
+    async def check_replica(self, replica: ReadReplica, primary_lsn: Optional[str] = None):
+        """
+        Probe a replica and record its replication lag. Replicas whose WAL
+        receiver is not streaming, or lagging past REPLICA_MAX_LAG_SECONDS,
+        are taken out of rotation until they catch up.
+        """
+        try:
+            if replica.pool is None:
+                # Bound the connect so a blackholed DSN doesn't stall the whole health round
+                replica.pool = await asyncpg.create_pool(
+                    to_asyncpg_url(replica.dsn), min_size=1, max_size=5, timeout=REPLICA_HEALTH_INTERVAL
+                )
+            async with replica.pool.acquire(timeout=REPLICA_HEALTH_INTERVAL) as conn:
+                probe = await conn.fetchrow(
+                    """
+                    SELECT pg_is_in_recovery() AS in_recovery,
+                           (SELECT pid FROM pg_stat_wal_receiver) IS NOT NULL AS receiver_running,
+                           (SELECT status FROM pg_stat_wal_receiver) AS receiver_status,
+                           pg_wal_lsn_diff($1::text::pg_lsn, pg_last_wal_replay_lsn()) AS bytes_behind,
+                           EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) AS replay_age
+                    """,
+                    primary_lsn,
+                    timeout=REPLICA_HEALTH_INTERVAL,
+                )
+        except Exception as e:
+            replica.mark_down(str(e))
+            return
+
+        if not probe["in_recovery"]:
+            # Not a standby, so there is nothing to lag behind
+            replica.lag_seconds = 0.0
+        elif not probe["receiver_running"]:
+            # Without a WAL receiver the replica has stopped receiving changes,
+            # so its data can be arbitrarily stale
+            replica.lag_seconds = None
+            replica.mark_down("WAL receiver is not running")
+            return
+        elif probe["receiver_status"] not in (None, "streaming"):
+            # status is only visible with pg_read_all_stats; NULL means we can't tell, not stopped
+            replica.lag_seconds = None
+            replica.mark_down(f"WAL receiver is {probe['receiver_status']}")
+            return
+        elif probe["bytes_behind"] is not None and probe["bytes_behind"] <= 0:
+            # Replayed up to the primary's current position: idle, not lagging
+            replica.lag_seconds = 0.0
+        elif probe["replay_age"] is not None:
+            replica.lag_seconds = float(probe["replay_age"])
+        else:
+            replica.lag_seconds = None
+            replica.mark_down("replica has not replayed any transactions")
+            return
+
+        if replica.lag_seconds > REPLICA_MAX_LAG_SECONDS:
+            replica.mark_down(f"replication lag {replica.lag_seconds:.1f}s exceeds {REPLICA_MAX_LAG_SECONDS}s")
+        else:
+            replica.healthy = True
+            replica.last_error = None
+
+    def pick_replica(self) -> Optional[ReadReplica]:
+        candidates = [r for r in self.replicas if r.healthy and r.pool is not None]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda r: r.score())
+
+    async def fetch(self, sql: str) -> List[asyncpg.Record]:
+        """
+        Run a read-only query on a replica, failing over to the primary if no
+        replica is healthy or the chosen replica drops the connection.
+        Waiting longer than ``acquire_timeout`` for a connection raises
+        asyncio.TimeoutError, which the DB admission limiter treats as overload.
+        """
+        replica = self.pick_replica()
+        if replica is not None:
+            replica.outstanding += 1
+            started = time.monotonic()
+            try:
+                async with replica.pool.acquire(timeout=self.acquire_timeout) as conn:
+                    rows = await conn.fetch(sql)
+                replica.record_latency(time.monotonic() - started)
+                return rows
+            except asyncio.TimeoutError:
+                # A saturated pool is load, not a broken replica; don't spill it onto the primary
+                raise
+            except CONNECTION_ERRORS as e:
+                replica.mark_down(str(e))
+            finally:
+                replica.outstanding -= 1
+
+        pool = await self.get_primary()
+        async with pool.acquire(timeout=self.acquire_timeout) as conn:
+            return await conn.fetch(sql)
+
+    def status(self) -> List[Dict[str, Any]]:
+        # Keyed by position with a redacted target so credentials never reach /health
+        return [
+            {"index": i, "target": redact_dsn(r.dsn), **r.status()}
+            for i, r in enumerate(self.replicas)
+        ]
+
+router = ReplicaRouter(DATABASE_URL, DATABASE_READ_URLS)
+
+@app.on_event("startup")
+async def startup():
+    await router.start()
+
+@app.on_event("shutdown")
+async def shutdown():
+    await router.close()
+    LLM_EXECUTOR.shutdown(wait=False, cancel_futures=True)
+
+class AdmissionLimiter:
+    """
+    Adaptive concurrency limit for one pipeline stage.
+
+    The limit follows AIMD: while at least half of it is in use, it grows by
+    roughly one slot per limit's worth of fast completions, and it is cut
+    multiplicatively when latency exceeds the target or a call fails with one
+    of ``overload_errors``. Other failures, such as bad generated SQL, say
+    nothing about load and are not penalised.
+
+    Callers over the limit wait in a bounded queue served round-robin per
+    client key. While other keys are waiting, a key may hold at most
+    ``queue_per_key`` places; a lone key may use the whole queue. When the
+    queue is full a newcomer displaces the newest waiter of the busiest key
+    rather than being turned away. Requests that can't queue, or wait too
+    long, are shed with a 429 and a Retry-After hint.
+    """
+    def __init__(self, name: str, initial: int, max_limit: int, target_latency: float,
+                 overload_errors: tuple = (asyncio.TimeoutError,),
+                 queue_size: int = ADMISSION_QUEUE_SIZE, queue_per_key: int = ADMISSION_QUEUE_PER_KEY,
+                 queue_timeout: float = ADMISSION_QUEUE_TIMEOUT, min_limit: int = 1, backoff: float = 0.7):
+        self.name = name
+        self.overload_errors = overload_errors
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.target_latency = target_latency
+        self.queue_size = queue_size
+        self.queue_per_key = min(queue_per_key, queue_size)
+        self.queue_timeout = queue_timeout
+        self.backoff = backoff
+        self.in_flight = 0
+        self.queued = 0
+        self.shed = 0
+        self.latency = target_latency / 2
+        self._last_decrease = 0.0
+        self._waiters: "OrderedDict[str, deque[asyncio.Future]]" = OrderedDict()
+
+    def _has_capacity(self) -> bool:
+        return self.in_flight < max(self.min_limit, int(self.limit))
+
+    def _retry_after(self) -> int:
+        # Time for the current backlog to drain at the current limit
+        backlog = self.in_flight + self.queued
+        return max(1, math.ceil(self.latency * backlog / max(self.limit, 1)))
+
+    def _overloaded(self, reason: str) -> HTTPException:
+        self.shed += 1
+        return HTTPException(
+            status_code=429,
+            detail=f"{self.name} stage overloaded: {reason}",
+            headers={"Retry-After": str(self._retry_after())},
+        )
+
+    def _reject(self, reason: str):
+        raise self._overloaded(reason)
+
+    def _make_room(self, key: str):
+        """
+        Free a queue place for ``key`` by shedding the newest waiter of the key
+        with the most queued requests, as long as that key would still have
+        more queued than ``key`` afterwards.
+        """
+        if not self._waiters:
+            self._reject("queue full")
+        mine = len(self._waiters.get(key, ()))
+        busiest, waiters = max(self._waiters.items(), key=lambda item: len(item[1]))
+        if len(waiters) <= mine + 1:
+            self._reject("queue full")
+        waiter = waiters.pop()
+        self.queued -= 1
+        waiter.set_exception(self._overloaded("displaced by another client"))
+
+    async def acquire(self, key: str):
+        if self.queued == 0 and self._has_capacity():
+            self.in_flight += 1
+            return
+        others_waiting = len(self._waiters) > (1 if key in self._waiters else 0)
+        if others_waiting and len(self._waiters.get(key, ())) >= self.queue_per_key:
+            self._reject("too many queued requests for this client")
+        if self.queued >= self.queue_size:
+            self._make_room(key)
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(key, deque()).append(waiter)
+        self.queued += 1
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            if waiter.done():
+                # Settled just as the wait expired: either granted (keep the slot) or displaced
+                return waiter.result()
+            self._remove_waiter(key, waiter)
+            self._reject("timed out waiting for a slot")
+        except asyncio.CancelledError:
+            if not waiter.done():
+                self._remove_waiter(key, waiter)
+            elif waiter.exception() is None:
+                self.release(None)
+            raise
+
+    def _remove_waiter(self, key: str, waiter: asyncio.Future):
+        waiters = self._waiters.get(key)
+        if waiters and waiter in waiters:
+            waiters.remove(waiter)
+            self.queued -= 1
+            if not waiters:
+                del self._waiters[key]
+
+    def is_overload(self, exc: BaseException) -> bool:
+        # Endpoints wrap errors in HTTPException, so also look at the cause
+        while exc is not None:
+            if isinstance(exc, self.overload_errors):
+                return True
+            exc = exc.__cause__
+        return False
+
+    def release(self, elapsed: Optional[float], overloaded: bool = False):
+        """
+        Free a slot. ``elapsed`` is None when the call gave no usable latency
+        sample (e.g. it was cancelled), in which case the limit is left alone.
+        """
+        # Only a limit that is actually being used has earned an increase;
+        # otherwise light serial traffic would ratchet it up to max_limit
+        busy = self.in_flight >= self.limit / 2
+        self.in_flight -= 1
+        if elapsed is not None:
+            self.latency = 0.8 * self.latency + 0.2 * elapsed
+            now = time.monotonic()
+            if overloaded or elapsed > self.target_latency:
+                # Cut at most once per target latency window so a burst of slow
+                # completions from the same overload doesn't collapse the limit
+                if now - self._last_decrease > self.target_latency:
+                    self.limit = max(self.min_limit, self.limit * self.backoff)
+                    self._last_decrease = now
+            elif busy:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+        self._dispatch()
+
+    def _dispatch(self):
+        # Hand freed slots out one key at a time so no single caller monopolises the queue
+        while self._waiters and self._has_capacity():
+            key, waiters = next(iter(self._waiters.items()))
+            waiter = waiters.popleft()
+            self.queued -= 1
+            if waiters:
+                self._waiters.move_to_end(key)
+            else:
+                del self._waiters[key]
+            self.in_flight += 1
+            waiter.set_result(None)
+
+    @asynccontextmanager
+    async def slot(self, key: str):
+        await self.acquire(key)
+        started = time.monotonic()
+        try:
+            yield
+        except asyncio.CancelledError:
+            self.release(None)
+            raise
+        except BaseException as e:
+            self.release(time.monotonic() - started, self.is_overload(e))
+            raise
+        self.release(time.monotonic() - started)
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "limit": round(self.limit, 2),
+            "in_flight": self.in_flight,
+            "queue_depth": self.queued,
+            "shed": self.shed,
+            "latency_ms": round(self.latency * 1000, 2),
+        }
+
+# The Groq client is synchronous. Its calls get their own threads, one per LLM
+# slot, so the LLM limit is the real bound on calls in flight and measured
+# latency doesn't include time spent queued behind the default executor.
+LLM_EXECUTOR = ThreadPoolExecutor(max_workers=LLM_MAX_CONCURRENCY, thread_name_prefix="groq")
+
+async def run_llm_call(fn, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(LLM_EXECUTOR, partial(fn, **kwargs))
+
+llm_limiter = AdmissionLimiter(
+    "llm", LLM_CONCURRENCY, LLM_MAX_CONCURRENCY, LLM_TARGET_LATENCY,
+    overload_errors=(asyncio.TimeoutError, RateLimitError, APITimeoutError),
+)
+db_limiter = AdmissionLimiter(
+    "db", DB_CONCURRENCY, DB_MAX_CONCURRENCY, DB_TARGET_LATENCY,
+    overload_errors=(asyncio.TimeoutError, asyncpg.TooManyConnectionsError, asyncpg.QueryCanceledError),
+)
 
 # LLM SQL generation
 async def generate_sql(question: str, schema_context: Optional[str] = None) -> tuple[str, str]:
@@ -137,7 +584,8 @@ User Question: {question}
 SQL Query:"""
 
     try:
-        response = client.chat.completions.create(
+        response = await run_llm_call(
+            client.chat.completions.create,
             model="llama-3.1-70b-versatile",
             messages=[
                 {
@@ -162,7 +610,8 @@ SQL Query:"""
         
         # Generate explanation
         explain_prompt = f"Explain what this SQL query does in one sentence: {sql}"
-        explain_response = client.chat.completions.create(
+        explain_response = await run_llm_call(
+            client.chat.completions.create,
             model="llama-3.1-70b-versatile",
             messages=[
                 {"role": "user", "content": explain_prompt}
@@ -174,79 +623,80 @@ SQL Query:"""
         
         return sql, explain
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"LLM error: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"LLM error: {str(e)}") from e
 
 # Execute SQL query
-async def execute_sql(sql: str, pool: asyncpg.Pool) -> tuple[List[str], List[Dict[str, Any]], bool]:
+async def execute_sql(sql: str) -> tuple[List[str], List[Dict[str, Any]], bool]:
     """
     Execute SQL query and return columns, rows, and truncation flag.
+    Queries are routed to a read replica when one is configured and healthy.
     """
     try:
-        async with pool.acquire() as conn:
-            rows = await conn.fetch(sql)
-            
-            if not rows:
-                return [], [], False
-            
-            # Get column names
-            columns = list(rows[0].keys())
-            
-            # Convert rows to dictionaries
-            result_rows = []
-            truncated = False
-            max_rows = 1000
-            max_text_length = 500
+        rows = await router.fetch(sql)
+        if not rows:
+            return [], [], False
+        
+        # Get column names
+        columns = list(rows[0].keys())
+        
+        # Convert rows to dictionaries
+        result_rows = []
+        truncated = False
+        max_rows = 1000
+        max_text_length = 500
+        
+        for i, row in enumerate(rows):
+            if i >= max_rows:
+                truncated = True
+                break
             
-            for i, row in enumerate(rows):
-                if i >= max_rows:
-                    truncated = True
-                    break
-                
-                row_dict = {}
-                for col in columns:
-                    value = row[col]
-                    # Truncate long text fields
-                    if isinstance(value, str) and len(value) > max_text_length:
-                        value = value[:max_text_length] + "..."
-                    row_dict[col] = value
-                
-                result_rows.append(row_dict)
+            row_dict = {}
+            for col in columns:
+                value = row[col]
+                # Truncate long text fields
+                if isinstance(value, str) and len(value) > max_text_length:
+                    value = value[:max_text_length] + "..."
+                row_dict[col] = value
             
-            return columns, result_rows, truncated
+            result_rows.append(row_dict)
+        
+        return columns, result_rows, truncated
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}") from e
+
+def admission_status() -> Dict[str, Any]:
+    return {"llm": llm_limiter.status(), "db": db_limiter.status()}
 
 # Endpoints
 @app.get("/health")
 async def health():
     """Health check endpoint"""
     try:
-        pool = await get_db_pool()
+        pool = await router.get_primary()
         async with pool.acquire() as conn:
             await conn.fetchval("SELECT 1")
-        return {"status": "ok", "db": "connected"}
+        return {"status": "ok", "db": "connected", "replicas": router.status(), "admission": admission_status()}
     except Exception as e:
-        return {"status": "error", "db": "disconnected", "error": str(e)}
+        return {"status": "error", "db": "disconnected", "error": str(e), "replicas": router.status(), "admission": admission_status()}
 
 @app.post("/generate-sql", response_model=SQLResponse, dependencies=[Depends(verify_api_key)])
-async def generate_sql_endpoint(request: SQLRequest):
+async def generate_sql_endpoint(request: SQLRequest, key: str = Depends(client_key)):
     """
     Generate SQL from natural language and execute it.
     """
     try:
         # Generate SQL
-        sql, explain = await generate_sql(request.question, request.schema)
+        async with llm_limiter.slot(key):
+            sql, explain = await generate_sql(request.question, request.schema)
         
         # Sanitize SQL
         is_safe, sanitized_sql = sanitize_sql(sql)
         if not is_safe:
             raise HTTPException(status_code=400, detail=f"Unsafe SQL detected: {sanitized_sql}")
         
-        # Get database pool
-        pool = await get_db_pool()
-        
         # Execute SQL
-        columns, rows, truncated = await execute_sql(sanitized_sql, pool)
+        async with db_limiter.slot(key):
+            columns, rows, truncated = await execute_sql(sanitized_sql)
         
         return SQLResponse(
             sql=sanitized_sql,
@@ -261,16 +711,53 @@ async def generate_sql_endpoint(request: SQLRequest):
         raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
 
 @app.post("/chat-stream", dependencies=[Depends(verify_api_key)])
-async def chat_stream(request: SQLRequest):
+async def chat_stream(request: SQLRequest, key: str = Depends(client_key)):
     """
     Streaming endpoint for SQL generation (SSE).
+
+    The LLM stage is admitted before the stream opens, so overload there is a
+    plain 429. The DB stage is only reached after the 200 has been sent; if it
+    is shed, the error event carries ``status: 429`` and ``retry_after`` instead.
     """
     import json
     
+    # Admit before the stream starts so overload can still be answered with a 429
+    await llm_limiter.acquire(key)
+    llm_slot: Dict[str, Any] = {"held": True, "task": None}
+    
+    def release_llm_slot(elapsed: Optional[float] = None, overloaded: bool = False):
+        if llm_slot["held"]:
+            llm_slot["held"] = False
+            llm_limiter.release(elapsed, overloaded)
+    
+    def release_when_done(task: asyncio.Task):
+        if not task.cancelled():
+            task.exception()
+        release_llm_slot()
+    
+    def release_if_idle():
+        # Stream never reached the LLM call, or the call has already settled
+        if llm_slot["task"] is None or llm_slot["task"].done():
+            release_llm_slot()
+    
     async def generate():
         try:
             # Generate SQL
-            sql, explain = await generate_sql(request.question, request.schema)
+            started = time.monotonic()
+            task = asyncio.create_task(generate_sql(request.question, request.schema))
+            llm_slot["task"] = task
+            try:
+                sql, explain = await asyncio.shield(task)
+            except asyncio.CancelledError:
+                # The client went away, but the Groq call runs in a worker thread that
+                # can't be cancelled. Hold the slot until it really finishes so the limit
+                # still bounds calls in flight, and release without a latency sample.
+                task.add_done_callback(release_when_done)
+                raise
+            except Exception as e:
+                release_llm_slot(time.monotonic() - started, llm_limiter.is_overload(e))
+                raise
+            release_llm_slot(time.monotonic() - started)
             
             # Sanitize SQL
             is_safe, sanitized_sql = sanitize_sql(sql)
@@ -282,16 +769,22 @@ async def chat_stream(request: SQLRequest):
             yield f"data: {json.dumps({'type': 'sql', 'sql': sanitized_sql, 'explain': explain})}\n\n"
             
             # Execute SQL
-            pool = await get_db_pool()
-            columns, rows, truncated = await execute_sql(sanitized_sql, pool)
+            async with db_limiter.slot(key):
+                columns, rows, truncated = await execute_sql(sanitized_sql)
             
             # Send results
             yield f"data: {json.dumps({'type': 'results', 'columns': columns, 'rows': rows, 'truncated': truncated})}\n\n"
             yield "data: [DONE]\n\n"
+        except HTTPException as e:
+            event = {'error': e.detail, 'status': e.status_code}
+            if e.headers and "Retry-After" in e.headers:
+                event['retry_after'] = int(e.headers["Retry-After"])
+            yield f"data: {json.dumps(event)}\n\n"
         except Exception as e:
             yield f"data: {json.dumps({'error': str(e)})}\n\n"
     
-    return StreamingResponse(generate(), media_type="text/event-stream")
+    # Runs even if the client disconnects before the stream is consumed
+    return StreamingResponse(generate(), media_type="text/event-stream", background=BackgroundTask(release_if_idle))
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,285 @@
+import asyncio
+import json
+import threading
+from types import SimpleNamespace
+
+import asyncpg
+import pytest
+from fastapi import HTTPException
+
+import main_original
+from main_original import AdmissionLimiter, client_key
+
+
+def make_limiter(**kwargs):
+    options = dict(initial=2, max_limit=10, target_latency=1.0, queue_size=4, queue_per_key=4, queue_timeout=1.0)
+    options.update(kwargs)
+    return AdmissionLimiter(
+        "db",
+        overload_errors=(asyncio.TimeoutError, asyncpg.TooManyConnectionsError),
+        **options,
+    )
+
+
+async def queue(limiter, key):
+    """Start an acquire that is expected to wait and let it reach the queue."""
+    task = asyncio.create_task(limiter.acquire(key))
+    await asyncio.sleep(0)
+    return task
+
+
+def test_limit_grows_on_fast_completions_under_load():
+    limiter = make_limiter()
+
+    async def run():
+        for _ in range(3):
+            await limiter.acquire("a")
+            await limiter.acquire("a")
+            limiter.release(0.01)
+            limiter.release(0.01)
+
+    asyncio.run(run())
+
+    # Roughly +1/limit per busy completion: 2 + 1/2 + 1/2.5 + ...
+    assert 3 < limiter.limit < 4.5
+    assert limiter.in_flight == 0
+
+
+def test_limit_does_not_grow_under_light_serial_load():
+    limiter = make_limiter(initial=4)
+
+    async def run():
+        for _ in range(50):
+            await limiter.acquire("a")
+            limiter.release(0.01)
+
+    asyncio.run(run())
+
+    assert limiter.limit == 4
+
+
+def test_limit_backs_off_on_slow_completion_once_per_window():
+    limiter = make_limiter(initial=10)
+
+    async def run():
+        for _ in range(3):
+            await limiter.acquire("a")
+            limiter.release(5.0)
+
+    asyncio.run(run())
+
+    assert limiter.limit == pytest.approx(7.0)
+
+
+def test_limit_backs_off_on_overload_error_but_not_query_error():
+    limiter = make_limiter(initial=10)
+
+    async def fail(error):
+        try:
+            async with limiter.slot("a"):
+                try:
+                    raise error
+                except Exception as e:
+                    raise HTTPException(status_code=500, detail="Database error") from e
+        except HTTPException:
+            pass
+
+    asyncio.run(fail(asyncpg.UndefinedColumnError("no such column")))
+    assert limiter.limit >= 10
+
+    asyncio.run(fail(asyncpg.TooManyConnectionsError("too many")))
+    assert limiter.limit < 10
+
+
+def test_release_without_sample_leaves_limit_alone():
+    limiter = make_limiter(initial=5)
+
+    async def run():
+        await limiter.acquire("a")
+        limiter.release(None)
+
+    asyncio.run(run())
+
+    assert limiter.limit == 5
+    assert limiter.in_flight == 0
+
+
+def test_queue_full_is_rejected_with_retry_after():
+    limiter = make_limiter(initial=1, queue_size=2)
+
+    async def run():
+        await limiter.acquire("a")
+        waiters = [await queue(limiter, "b"), await queue(limiter, "c")]
+        with pytest.raises(HTTPException) as rejected:
+            await limiter.acquire("d")
+        for waiter in waiters:
+            waiter.cancel()
+        return rejected.value
+
+    error = asyncio.run(run())
+
+    assert error.status_code == 429
+    assert int(error.headers["Retry-After"]) >= 1
+    assert limiter.shed == 1
+
+
+def test_queue_timeout_is_rejected_with_retry_after():
+    limiter = make_limiter(initial=1, queue_timeout=0.05)
+
+    async def run():
+        await limiter.acquire("a")
+        with pytest.raises(HTTPException) as rejected:
+            await limiter.acquire("b")
+        return rejected.value
+
+    error = asyncio.run(run())
+
+    assert error.status_code == 429
+    assert "Retry-After" in error.headers
+    assert limiter.queued == 0
+    assert limiter.in_flight == 1
+
+
+def test_slots_are_dispatched_round_robin_across_keys():
+    limiter = make_limiter(initial=1, queue_size=10)
+    order = []
+
+    async def run():
+        await limiter.acquire("holder")
+        tasks = []
+        for key in ["a", "a", "a", "b", "b"]:
+            task = await queue(limiter, key)
+            task.add_done_callback(lambda _, key=key: order.append(key))
+            tasks.append(task)
+        for _ in tasks:
+            limiter.release(0.01)
+            await asyncio.sleep(0)
+        await asyncio.gather(*tasks)
+
+    asyncio.run(run())
+
+    assert order == ["a", "b", "a", "b", "a"]
+
+
+def test_per_key_cap_rejects_only_the_greedy_key():
+    limiter = make_limiter(initial=1, queue_size=10, queue_per_key=2)
+
+    async def run():
+        await limiter.acquire("holder")
+        waiters = [await queue(limiter, "b"), await queue(limiter, "a"), await queue(limiter, "a")]
+        with pytest.raises(HTTPException):
+            await limiter.acquire("a")
+        waiters.append(await queue(limiter, "b"))
+        assert limiter.queued == 4
+        for waiter in waiters:
+            waiter.cancel()
+
+    asyncio.run(run())
+
+
+def test_lone_key_can_use_the_whole_queue():
+    limiter = make_limiter(initial=1, queue_size=5, queue_per_key=2)
+
+    async def run():
+        await limiter.acquire("holder")
+        waiters = [await queue(limiter, "shared") for _ in range(5)]
+        assert limiter.queued == 5
+        with pytest.raises(HTTPException):
+            await limiter.acquire("shared")
+        for waiter in waiters:
+            waiter.cancel()
+
+    asyncio.run(run())
+
+
+def test_full_queue_displaces_busiest_key():
+    limiter = make_limiter(initial=1, queue_size=3)
+
+    async def run():
+        await limiter.acquire("holder")
+        greedy = [await queue(limiter, "a") for _ in range(3)]
+        newcomer = await queue(limiter, "b")
+        await asyncio.sleep(0.01)
+
+        assert isinstance(greedy[-1].exception(), HTTPException)
+        assert not newcomer.done()
+        assert limiter.queued == 3
+        for waiter in greedy[:-1] + [newcomer]:
+            waiter.cancel()
+
+    asyncio.run(run())
+
+
+def test_cancel_while_queued_frees_the_place():
+    limiter = make_limiter(initial=1)
+
+    async def run():
+        await limiter.acquire("holder")
+        waiter = await queue(limiter, "a")
+        waiter.cancel()
+        await asyncio.sleep(0.01)
+        assert limiter.queued == 0
+        limiter.release(0.01)
+
+    asyncio.run(run())
+
+    assert limiter.in_flight == 0
+    assert limiter._waiters == {}
+
+
+def test_cancelled_slot_is_released_without_latency_sample():
+    limiter = make_limiter(initial=5)
+
+    async def run():
+        async with limiter.slot("a"):
+            raise asyncio.CancelledError()
+
+    with pytest.raises(asyncio.CancelledError):
+        asyncio.run(run())
+
+    assert limiter.limit == 5
+    assert limiter.in_flight == 0
+
+
+def test_client_key_only_trusts_a_validated_api_key(monkeypatch):
+    request = SimpleNamespace(client=SimpleNamespace(host="10.0.0.1"))
+
+    monkeypatch.setattr(main_original, "VANNA_API_KEY", None)
+    assert asyncio.run(client_key(request, "Bearer anything")) == "host:10.0.0.1"
+
+    monkeypatch.setattr(main_original, "VANNA_API_KEY", "secret")
+    assert asyncio.run(client_key(request, "Bearer wrong")) == "host:10.0.0.1"
+    assert asyncio.run(client_key(request, "Bearer secret")) == "key:secret"
+
+
+def test_chat_stream_reports_db_shedding_with_retry_hint(monkeypatch):
+    async def fake_generate_sql(question, schema=None):
+        return "SELECT 1", "Selects one"
+
+    db = make_limiter(initial=1, queue_size=0)
+    monkeypatch.setattr(main_original, "generate_sql", fake_generate_sql)
+    monkeypatch.setattr(main_original, "db_limiter", db)
+
+    async def run():
+        await db.acquire("holder")
+        response = await main_original.chat_stream(main_original.SQLRequest(question="total spend"), key="a")
+        events = [chunk async for chunk in response.body_iterator]
+        await response.background()
+        return events
+
+    events = asyncio.run(run())
+
+    error = json.loads(events[-1][len("data: "):])
+    assert error["status"] == 429
+    assert error["retry_after"] >= 1
+
+
+def test_llm_calls_run_on_dedicated_executor_sized_to_llm_limit():
+    def create(**kwargs):
+        return threading.current_thread().name, kwargs
+
+    thread_name, kwargs = asyncio.run(main_original.run_llm_call(create, model="m"))
+
+    assert thread_name.startswith("groq")
+    assert kwargs == {"model": "m"}
+    assert main_original.LLM_EXECUTOR._max_workers == main_original.llm_limiter.max_limit
@@ -0,0 +1,233 @@
+import asyncio
+
+import asyncpg
+import pytest
+
+import main_original
+from main_original import ReplicaRouter, parse_dsn_list, redact_dsn
+
+
+class StubConnection:
+    def __init__(self, rows=None, error=None, probe=None, lsn="0/100"):
+        self.rows = rows or []
+        self.error = error
+        self.probe = probe
+        self.lsn = lsn
+        self.queries = []
+
+    async def fetch(self, sql):
+        self.queries.append(sql)
+        if self.error:
+            raise self.error
+        return self.rows
+
+    async def fetchrow(self, sql, *args, timeout=None):
+        return self.probe
+
+    async def fetchval(self, sql, timeout=None):
+        return self.lsn
+
+
+class StubPool:
+    def __init__(self, conn, saturated=False):
+        self.conn = conn
+        self.saturated = saturated
+        self.timeouts = []
+
+    def acquire(self, timeout=None):
+        pool = self
+        pool.timeouts.append(timeout)
+
+        class Acquire:
+            async def __aenter__(self):
+                if pool.saturated:
+                    raise asyncio.TimeoutError()
+                return pool.conn
+
+            async def __aexit__(self, *exc):
+                return False
+
+        return Acquire()
+
+
+def make_router(*replica_conns, primary_conn=None):
+    router = ReplicaRouter("postgresql://primary/db", [f"postgresql://r{i}/db" for i in range(len(replica_conns))])
+    router.primary = StubPool(primary_conn or StubConnection(rows=["primary"]))
+    for replica, conn in zip(router.replicas, replica_conns):
+        replica.pool = StubPool(conn)
+        replica.healthy = True
+    return router
+
+
+def probe(in_recovery=True, receiver_running=True, receiver_status="streaming", bytes_behind=0, replay_age=None):
+    return {
+        "in_recovery": in_recovery,
+        "receiver_running": receiver_running,
+        "receiver_status": receiver_status,
+        "bytes_behind": bytes_behind,
+        "replay_age": replay_age,
+    }
+
+
+def test_pick_replica_prefers_fewest_outstanding_weighted_by_latency():
+    router = make_router(StubConnection(), StubConnection(), StubConnection())
+    busy, fast, down = router.replicas
+    busy.outstanding = 3
+    down.healthy = False
+
+    assert router.pick_replica() is fast
+
+    fast.latency = 1.0
+    assert router.pick_replica() is busy
+
+
+def test_pick_replica_returns_none_without_healthy_replicas():
+    router = make_router(StubConnection())
+    router.replicas[0].healthy = False
+
+    assert router.pick_replica() is None
+
+
+def test_fetch_routes_to_replica():
+    replica_conn = StubConnection(rows=["replica"])
+    router = make_router(replica_conn)
+
+    rows = asyncio.run(router.fetch("SELECT 1"))
+
+    assert rows == ["replica"]
+    assert router.replicas[0].outstanding == 0
+
+
+def test_fetch_falls_back_to_primary_on_connection_error():
+    router = make_router(StubConnection(error=asyncpg.ConnectionDoesNotExistError("gone")))
+
+    rows = asyncio.run(router.fetch("SELECT 1"))
+
+    assert rows == ["primary"]
+    assert router.replicas[0].healthy is False
+    assert router.replicas[0].outstanding == 0
+
+
+def test_fetch_acquires_with_timeout():
+    router = make_router(StubConnection(rows=["replica"]))
+
+    asyncio.run(router.fetch("SELECT 1"))
+
+    assert router.replicas[0].pool.timeouts == [router.acquire_timeout]
+
+
+def test_fetch_raises_pool_timeout_without_failing_over():
+    router = make_router(StubConnection())
+    router.replicas[0].pool.saturated = True
+
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(router.fetch("SELECT 1"))
+
+    assert router.replicas[0].healthy is True
+    assert router.primary.timeouts == []
+
+
+def test_fetch_does_not_fail_over_on_query_error():
+    router = make_router(StubConnection(error=asyncpg.UndefinedColumnError("no such column")))
+
+    try:
+        asyncio.run(router.fetch("SELECT missing FROM invoices"))
+    except asyncpg.UndefinedColumnError:
+        pass
+    else:
+        raise AssertionError("query error should propagate")
+    assert router.replicas[0].healthy is True
+
+
+def test_fetch_uses_primary_without_replicas():
+    router = make_router()
+
+    assert asyncio.run(router.fetch("SELECT 1")) == ["primary"]
+
+
+def test_check_replica_caught_up_with_primary_is_healthy():
+    router = make_router(StubConnection(probe=probe(bytes_behind=0, replay_age=3600)))
+    replica = router.replicas[0]
+    replica.healthy = False
+
+    asyncio.run(router.check_replica(replica, "0/100"))
+
+    assert replica.healthy is True
+    assert replica.lag_seconds == 0.0
+
+
+def test_check_replica_marks_down_when_wal_receiver_not_running():
+    router = make_router(StubConnection(probe=probe(receiver_running=False, receiver_status=None, bytes_behind=0)))
+    replica = router.replicas[0]
+
+    asyncio.run(router.check_replica(replica, "0/100"))
+
+    assert replica.healthy is False
+    assert "not running" in replica.last_error
+
+
+def test_check_replica_marks_down_when_wal_receiver_not_streaming():
+    router = make_router(StubConnection(probe=probe(receiver_status="waiting", bytes_behind=0)))
+    replica = router.replicas[0]
+
+    asyncio.run(router.check_replica(replica, "0/100"))
+
+    assert replica.healthy is False
+    assert "waiting" in replica.last_error
+
+
+def test_check_replica_unprivileged_role_with_hidden_status_is_healthy():
+    # Without pg_read_all_stats the receiver's pid is visible but status reads NULL
+    router = make_router(StubConnection(probe=probe(receiver_status=None, bytes_behind=0)))
+    replica = router.replicas[0]
+    replica.healthy = False
+
+    asyncio.run(router.check_replica(replica, "0/100"))
+
+    assert replica.healthy is True
+    assert replica.lag_seconds == 0.0
+
+
+def test_check_replica_marks_down_when_lag_exceeds_threshold():
+    lag = main_original.REPLICA_MAX_LAG_SECONDS + 1
+    router = make_router(StubConnection(probe=probe(bytes_behind=4096, replay_age=lag)))
+    replica = router.replicas[0]
+
+    asyncio.run(router.check_replica(replica, "0/100"))
+
+    assert replica.healthy is False
+    assert replica.lag_seconds == lag
+
+
+def test_check_replica_without_primary_lsn_uses_replay_age():
+    router = make_router(StubConnection(probe=probe(bytes_behind=None, replay_age=1.5)))
+    replica = router.replicas[0]
+
+    asyncio.run(router.check_replica(replica, None))
+
+    assert replica.healthy is True
+    assert replica.lag_seconds == 1.5
+
+
+def test_status_is_keyed_by_index_and_redacted():
+    router = ReplicaRouter(None, [
+        "postgresql://user:secret@db:5432/flowbit?password=secret",
+        "postgresql://user:secret@db:5432/flowbit?sslmode=require",
+    ])
+
+    status = router.status()
+
+    assert [entry["index"] for entry in status] == [0, 1]
+    assert all(entry["target"] == "db:5432/flowbit" for entry in status)
+    assert "secret" not in repr(status)
+    assert redact_dsn("postgresql+psycopg://db") == "db:5432"
+
+
+def test_redact_dsn_handles_multi_host_dsn():
+    assert redact_dsn("postgresql://u:p@h1:5432,h2:5433/db?password=x") == "h1:5432,h2:5433/db"
+
+
+def test_parse_dsn_list_keeps_multi_host_dsns_intact():
+    dsns = parse_dsn_list("postgresql://u:p@h1:5432,h2:5433/db, postgresql://u:p@r2/db,")
+
+    assert dsns == ["postgresql://u:p@h1:5432,h2:5433/db", "postgresql://u:p@r2/db"]